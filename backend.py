@@ -1,13 +1,22 @@
+import asyncio
+import json
 import logging
 import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
 from contextlib import asynccontextmanager
 from urllib.parse import quote
 
-from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException
+import numpy as np
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from fastapi.security import APIKeyHeader
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_mariadb import MariaDBStore
 from mariadb.connectionpool import ConnectionPool
+from mariadb.constants import CLIENT
 
 # MariaDB connection details
 DB_HOST = os.getenv("DB_HOST", "127.0.0.1")
@@ -15,15 +24,26 @@ DB_PORT = int(os.getenv("DB_PORT", 3306))
 DB_USER = os.getenv("DB_USER", "root")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
 DB_NAME = os.getenv("DB_NAME", "demo")
-DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", max(16, 2 * (os.cpu_count() or 1))))
 
 # Embedding model details
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "gemini-embedding-001")
 EMBEDDING_LENGTH = int(os.getenv("EMBEDDING_LENGTH", 3072))
 EMBEDDING_TIMEOUT_SECS = int(os.getenv("EMBED_TIMEOUT_SECS", 30))
 EMBEDDING_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 100))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", 8))
+INSERT_COMMIT_BATCHES = int(os.getenv("INSERT_COMMIT_BATCHES", 10))
+HNSW_M = int(os.getenv("HNSW_M", 16))
 COLLECTION_NAME = "products.description"
 
+# Query-embedding cache details
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", 2000))
+EMBEDDING_CACHE_TTL_SECS = int(os.getenv("EMBED_CACHE_TTL_SECS", 300))
+
+# Semantic result cache details
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", 1024))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.97))
+
 # Logging configuration
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 logging.basicConfig(
@@ -76,8 +96,21 @@ async def lifespan(app: FastAPI):
         password=DB_PASSWORD,
         database=DB_NAME,
         ssl=True,
+        client_flag=CLIENT.MULTI_STATEMENTS,
+        # COM_RESET_CONNECTION on pool return would deallocate the
+        # server-side prepared statements cached per connection; these
+        # sessions hold no state that needs resetting
+        pool_reset_connection=False,
     )
 
+    # Schema pieces the search path depends on (generated columns and
+    # their indexes) must exist before the first request
+    ensure_search_schema(app.state.connection_pool)
+
+    # Guards against concurrent ingestion runs
+    app.state.ingestion_lock = asyncio.Lock()
+    app.state.ingestion_task = None
+
     try:
         yield
     finally:
@@ -85,99 +118,339 @@ async def lifespan(app: FastAPI):
 
 
 # Fast API object
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 
-def run_product_ingestion(connection_pool: ConnectionPool, vector_store: MariaDBStore):
-    with connection_pool.get_connection() as connection, connection.cursor() as cursor:
-        # Add created_at column if it doesn't exist
+# Query-embedding LRU cache with TTL (repeat queries skip the embedding API)
+_embedding_cache: OrderedDict = OrderedDict()
+_embedding_cache_lock = threading.Lock()
+
+
+def _embed_query(query: str) -> list[float]:
+    now = time.monotonic()
+    with _embedding_cache_lock:
+        entry = _embedding_cache.get(query)
+        if entry is not None and now - entry[0] < EMBEDDING_CACHE_TTL_SECS:
+            _embedding_cache.move_to_end(query)
+            return entry[1]
+
+    # Normalize to unit length to match the vectors stored at ingestion time
+    vector = _unit_vector(app.state.embeddings.embed_query(query)).tolist()
+
+    with _embedding_cache_lock:
+        _embedding_cache[query] = (now, vector)
+        _embedding_cache.move_to_end(query)
+        while len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+            _embedding_cache.popitem(last=False)
+    return vector
+
+
+# Semantic result cache (near-duplicate queries skip the vector search)
+_semantic_cache_lock = threading.Lock()
+_semantic_cache_vectors = np.zeros(
+    (SEMANTIC_CACHE_SIZE, EMBEDDING_LENGTH), dtype=np.float32
+)
+_semantic_cache_entries: list = []  # (category, k, results) parallel to the rows above
+_semantic_cache_next = 0
+
+
+def _unit_vector(vector) -> np.ndarray:
+    unit = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(unit)
+    return unit / norm if norm else unit
+
+
+def _semantic_cache_get(query_vector: list[float], category: str, k: int):
+    query_unit = _unit_vector(query_vector)
+    with _semantic_cache_lock:
+        count = len(_semantic_cache_entries)
+        if count == 0:
+            return None
+        similarities = _semantic_cache_vectors[:count] @ query_unit
+        for index in np.argsort(similarities)[::-1]:
+            if similarities[index] < SEMANTIC_CACHE_THRESHOLD:
+                break
+            cached_category, cached_k, cached_results = _semantic_cache_entries[index]
+            if cached_category == category and cached_k >= k:
+                return cached_results[:k]
+    return None
+
+
+def _semantic_cache_put(query_vector: list[float], category: str, k: int, results):
+    global _semantic_cache_next
+    query_unit = _unit_vector(query_vector)
+    with _semantic_cache_lock:
+        if len(_semantic_cache_entries) < SEMANTIC_CACHE_SIZE:
+            _semantic_cache_vectors[len(_semantic_cache_entries)] = query_unit
+            _semantic_cache_entries.append((category, k, results))
+        else:
+            # Full: overwrite the oldest entry
+            _semantic_cache_vectors[_semantic_cache_next] = query_unit
+            _semantic_cache_entries[_semantic_cache_next] = (category, k, results)
+            _semantic_cache_next = (_semantic_cache_next + 1) % SEMANTIC_CACHE_SIZE
+
+
+def vector_literal(vector) -> str:
+    return "[" + ",".join(map(str, vector)) + "]"
+
+
+def insert_embedding_batch(cursor, collection_id: str, batch_rows, vectors):
+    # MariaDB stores VECTOR columns as 32-bit floats, so down-convert the
+    # embeddings before serializing: half the in-process footprint of the
+    # Python float lists and much shorter Vec_FromText literals on the wire
+    vectors = np.asarray(vectors, dtype=np.float32)
+
+    # Store unit-length vectors so each cosine distance evaluation reduces to
+    # 1 - dot product (no norms to compute per candidate)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    vectors /= norms
+
+    # Insert the whole batch as one bulk multi-row INSERT instead of letting
+    # add_embeddings issue one INSERT per row
+    rows = [
+        (
+            str(uuid.uuid4()),
+            collection_id,
+            description,
+            json.dumps({"id": id, "name": name, "category": category}),
+            vector_literal(vector),
+        )
+        for (id, name, description, category), vector in zip(batch_rows, vectors)
+    ]
+    cursor.executemany(
+        """
+        INSERT INTO langchain_embedding (id, collection_id, content, metadata, embedding)
+        VALUES (?, ?, ?, ?, Vec_FromText(?));
+        """,
+        rows,
+    )
+
+
+def ensure_search_schema(connection_pool):
+    # Generated columns and indexes used by both search and ingestion: the
+    # category filter in /search-products needs langchain_embedding.category
+    # to exist on a fresh database, before the first ingestion ever runs
+    connection = connection_pool.get_connection()
+    try:
+        cursor = connection.cursor()
         cursor.execute(
             """
             ALTER TABLE langchain_embedding
-            ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
-            """)
+            ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS category VARCHAR(64)
+                GENERATED ALWAYS AS (JSON_VALUE(metadata, '$.category')) STORED,
+            ADD COLUMN IF NOT EXISTS product_id BIGINT
+                GENERATED ALWAYS AS (JSON_VALUE(metadata, '$.id')) STORED,
+            ADD INDEX IF NOT EXISTS idx_category_collection (category, collection_id),
+            ADD INDEX IF NOT EXISTS idx_collection_product (collection_id, product_id);
+            """
+        )
+        cursor.execute(
+            """
+            ALTER TABLE products
+            ADD COLUMN IF NOT EXISTS has_description TINYINT(1)
+                GENERATED ALWAYS AS (description IS NOT NULL AND TRIM(description) <> '') STORED,
+            ADD INDEX IF NOT EXISTS idx_has_description (has_description, id);
+            """
+        )
+    finally:
+        connection.close()
+
+
+def prepare_ingestion(cursor):
+    # Run the pre-ingestion cleanup as one pipelined multi-statement round
+    # trip: delete embeddings for products that no longer exist (orphaned
+    # embeddings), and delete embeddings for products that were updated
+    # (outdated embeddings). The collection label is an app constant, so
+    # inlining it is safe (multi-statement mode can't bind parameters).
+    cursor.execute(
+        f"""
+        DELETE e FROM langchain_embedding e
+        JOIN langchain_collection c ON c.id = e.collection_id
+        LEFT JOIN products p ON p.id = e.product_id
+        WHERE c.label = '{COLLECTION_NAME}'
+            AND p.id IS NULL;
+
+        DELETE e FROM langchain_embedding e
+        JOIN langchain_collection c ON c.id = e.collection_id
+        JOIN products p ON p.id = e.product_id
+        WHERE c.label = '{COLLECTION_NAME}'
+            AND p.updated_at > e.created_at
+            AND p.has_description = 1;
+        """
+    )
+
+    # Collect the per-statement rowcounts from the pipelined result sets
+    rowcounts = [cursor.rowcount]
+    while cursor.nextset():
+        rowcounts.append(cursor.rowcount)
+    orphaned_count, outdated_count = rowcounts[0], rowcounts[1]
+
+    log.info(
+        f"Deleted {orphaned_count} orphaned embeddings and {outdated_count} outdated embeddings"
+    )
 
-        # Delete embeddings for products that no longer exist (orphaned embeddings)
+    # Look up the collection id (created by MariaDBStore at startup)
+    cursor.execute(
+        "SELECT id FROM langchain_collection WHERE label = ?;", (COLLECTION_NAME,)
+    )
+    collection_row = cursor.fetchone()
+    if collection_row is None:
+        log.error(f"Collection {COLLECTION_NAME} not found, aborting ingestion")
+        return None
+    collection_id = collection_row[0]
+
+    # Make sure the embedding column has an HNSW vector index so searches
+    # traverse the ANN graph instead of scanning every vector
+    cursor.execute(
+        """
+        SELECT COUNT(*) FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE()
+            AND TABLE_NAME = 'langchain_embedding'
+            AND INDEX_TYPE = 'VECTOR';
+        """
+    )
+    if cursor.fetchone()[0] == 0:
         cursor.execute(
+            f"""
+            ALTER TABLE langchain_embedding
+            ADD VECTOR INDEX idx_embedding (embedding) M={HNSW_M} DISTANCE=cosine;
             """
-            DELETE e FROM langchain_embedding e
-            JOIN langchain_collection c ON c.id = e.collection_id
-            LEFT JOIN products p ON p.id = JSON_VALUE(e.metadata, '$.id')
-            WHERE c.label = ?
-                AND p.id IS NULL;
-            """,
-            (COLLECTION_NAME,),
         )
-        orphaned_count = cursor.rowcount
+        log.info("Created HNSW vector index on langchain_embedding")
+
+    return collection_id
+
 
-        # Delete embeddings for products that were updated (outdated embeddings)
+def fetch_product_batches(cursor, last_product_id: int):
+    # Fetch up to EMBEDDING_CONCURRENCY batches of products that need
+    # embeddings, seeking past the last processed id instead of using a
+    # growing OFFSET
+    batches = []
+    for _ in range(EMBEDDING_CONCURRENCY):
         cursor.execute(
             """
-            DELETE e FROM langchain_embedding e
-            JOIN langchain_collection c ON c.id = e.collection_id
-            JOIN products p ON p.id = JSON_VALUE(e.metadata, '$.id')
-            WHERE c.label = ?
-                AND p.updated_at > e.created_at
-                AND p.description IS NOT NULL
-                AND TRIM(p.description) <> '';
+            SELECT p.id, p.name, p.description, p.category
+            FROM products p
+                LEFT JOIN langchain_collection c ON c.label = ?
+                LEFT JOIN langchain_embedding e ON e.collection_id = c.id
+                AND e.product_id = p.id
+            WHERE e.id IS NULL
+                AND p.id > ?
+                AND p.has_description = 1
+            ORDER BY p.id
+            LIMIT ?;
             """,
-            (COLLECTION_NAME,),
+            (COLLECTION_NAME, last_product_id, EMBEDDING_BATCH_SIZE),
         )
-        outdated_count = cursor.rowcount
+        batch_rows = cursor.fetchall()
+        if not batch_rows:
+            break
+        last_product_id = batch_rows[-1][0]
+        batches.append(batch_rows)
+    return batches, last_product_id
 
-        cursor.execute("COMMIT;")
-        log.info(
-            f"Deleted {orphaned_count} orphaned embeddings and {outdated_count} outdated embeddings"
-        )
+
+async def run_product_ingestion(
+    connection_pool: ConnectionPool,
+    embeddings: GoogleGenerativeAIEmbeddings,
+):
+    # One dedicated connection serves the cleanup and the batch SELECT loop;
+    # inserts pull their own connections from the pool so writes don't queue
+    # behind reads on a single session. All blocking driver calls run in
+    # threads so the event loop stays free for request handlers.
+    with connection_pool.get_connection() as connection, connection.cursor() as cursor:
+        # The ALTERs commit implicitly (DDL); autocommit covers the cleanup
+        # DELETEs without spending a round trip on an explicit COMMIT
+        connection.autocommit = True
+
+        collection_id = await asyncio.to_thread(prepare_ingestion, cursor)
+        if collection_id is None:
+            return
 
         # process products that either don't have embeddings
         total_ingested = 0
+        last_product_id = 0
         has_more_products = True
-
-        while has_more_products:
-            # Fetch a batch of products that need embeddings
-            cursor.execute(
-                """
-                SELECT p.id, p.name, p.description, p.category
-                FROM products p
-                    LEFT JOIN langchain_collection c ON c.label = ?
-                    LEFT JOIN langchain_embedding e ON e.collection_id = c.id
-                    AND JSON_VALUE(e.metadata, '$.id') = p.id
-                WHERE e.id IS NULL
-                    AND p.description IS NOT NULL
-                    AND TRIM(p.description) <> ''
-                ORDER BY p.id
-                LIMIT ? OFFSET ?;
-                """,
-                (COLLECTION_NAME, EMBEDDING_BATCH_SIZE, total_ingested),
-            )
-            batch_rows = cursor.fetchall()
-
-            has_more_products = bool(batch_rows)
-
-            # Process this batch if we have any products
-            if has_more_products:
-                vector_store.add_texts(
-                    texts=[description for _, _, description, _ in batch_rows],
-                    metadatas=[
-                        {"id": id, "name": name, "category": category}
-                        for id, name, _, category in batch_rows
-                    ],
-                )
-                total_ingested += len(batch_rows)
-                log.info(f"Ingested batch of {len(batch_rows)} products")
+        batches_since_commit = 0
+        embedding_semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+
+        async def embed_batch(texts: list[str]) -> list[list[float]]:
+            # Embed the whole batch in a single API call instead of letting
+            # add_texts embed row by row
+            async with embedding_semaphore:
+                return await asyncio.to_thread(embeddings.embed_documents, texts)
+
+        # Inserts run on their own connection in one transaction, committed
+        # every INSERT_COMMIT_BATCHES batches to amortize redo-log flushes
+        with connection_pool.get_connection() as write_connection:
+            with write_connection.cursor() as write_cursor:
+                write_connection.autocommit = False
+
+                while has_more_products:
+                    batches, last_product_id = await asyncio.to_thread(
+                        fetch_product_batches, cursor, last_product_id
+                    )
+                    has_more_products = len(batches) == EMBEDDING_CONCURRENCY
+
+                    # Embed the fetched batches concurrently, then insert them
+                    vector_batches = await asyncio.gather(
+                        *[
+                            embed_batch(
+                                [description for _, _, description, _ in batch_rows]
+                            )
+                            for batch_rows in batches
+                        ]
+                    )
+                    for batch_rows, vectors in zip(batches, vector_batches):
+                        await asyncio.to_thread(
+                            insert_embedding_batch,
+                            write_cursor,
+                            collection_id,
+                            batch_rows,
+                            vectors,
+                        )
+                        batches_since_commit += 1
+                        if batches_since_commit >= INSERT_COMMIT_BATCHES:
+                            await asyncio.to_thread(write_connection.commit)
+                            batches_since_commit = 0
+                        total_ingested += len(batch_rows)
+                        log.info(f"Ingested batch of {len(batch_rows)} products")
+
+                if batches_since_commit:
+                    await asyncio.to_thread(write_connection.commit)
 
     log.info(f"Total products ingested: {total_ingested}")
 
 
 # /ingest-products endpoint
 @app.post("/ingest-products")
-def ingest_products(
-    background_tasks: BackgroundTasks, _: str = Depends(verify_api_key)
-):
-    connection_pool: ConnectionPool = app.state.connection_pool
-    vector_store: MariaDBStore = app.state.vector_store
-    background_tasks.add_task(run_product_ingestion, connection_pool, vector_store)
+async def ingest_products(_: str = Depends(verify_api_key)):
+    # Gate on the task handle, not the lock: create_task only schedules the
+    # coroutine, so the lock can still look free when a run is already
+    # queued. This handler has no await before the task is stored, so the
+    # check-and-create below is atomic on the event loop
+    if app.state.ingestion_task and not app.state.ingestion_task.done():
+        return {
+            "status": "Ingestion already running",
+            "message": "A product ingestion is already in progress",
+        }
+
+    async def run_with_lock():
+        async with app.state.ingestion_lock:
+            try:
+                await run_product_ingestion(
+                    app.state.connection_pool, app.state.embeddings
+                )
+            except Exception:
+                # Surface failures of the fire-and-forget task in the log;
+                # otherwise they only show up as an unretrieved-exception
+                # warning at garbage-collection time
+                log.exception("Product ingestion failed")
+
+    # Keep a reference so the task isn't garbage-collected mid-run
+    app.state.ingestion_task = asyncio.create_task(run_with_lock())
 
     return {
         "status": "Ingestion started",
@@ -185,21 +458,58 @@ def ingest_products(
     }
 
 
+# Vector search statement, queries the ANN index directly so the traversal
+# uses VEC_DISTANCE_COSINE, matching the index distance. Kept as a single
+# constant so the prepared-statement cursor reuses one server-side handle
+SEARCH_PRODUCTS_SQL = """
+    SELECT CAST(JSON_VALUE(e.metadata, '$.id') AS INTEGER),
+        JSON_VALUE(e.metadata, '$.name'),
+        e.content
+    FROM langchain_embedding e
+    JOIN langchain_collection c ON c.id = e.collection_id
+    WHERE c.label = ?
+        AND e.category = ?
+    ORDER BY VEC_DISTANCE_COSINE(e.embedding, Vec_FromText(?))
+    LIMIT ?;
+    """
+
+
 # /search-products endpoint
 @app.get("/search-products")
 def search_products(
     search_query: str, category: str, k: int = 10, _: str = Depends(verify_api_key)
 ):
-    vector_store: MariaDBStore = app.state.vector_store
-    documents = vector_store.similarity_search(search_query, k, {"category": category})
+    query_vector = _embed_query(search_query)
+
+    cached_results = _semantic_cache_get(query_vector, category, k)
+    if cached_results is not None:
+        return {"results": cached_results}
+
+    # Execute the search statement through a server-side prepared cursor
+    # cached on each pooled connection: the statement is parsed and planned
+    # only the first time a connection serves a search, and the pool keeps
+    # validating and replacing connections underneath. Pull 2*k candidates
+    # to compensate for rows the category filter drops after the ANN pass,
+    # reusing the one query embedding computed above
+    connection = app.state.connection_pool.get_connection()
+    try:
+        cursor = getattr(connection, "_search_cursor", None)
+        if cursor is None:
+            cursor = connection.cursor(prepared=True)
+            connection._search_cursor = cursor
+        cursor.execute(
+            SEARCH_PRODUCTS_SQL,
+            (COLLECTION_NAME, category, vector_literal(query_vector), k * 2),
+        )
+        rows = cursor.fetchall()
+    finally:
+        connection.close()  # returns the connection to the pool
+
     results = [
-        {
-            "id": doc.metadata.get("id"),
-            "name": doc.metadata.get("name"),
-            "description": doc.page_content,
-        }
-        for doc in documents
-    ]
+        {"id": id, "name": name, "description": content}
+        for (id, name, content) in rows
+    ][:k]
+    _semantic_cache_put(query_vector, category, k, results)
     return {"results": results}
 
 
@@ -1,15 +1,25 @@
+import asyncio
 import logging
 import os
-import random
 from typing import Dict, List, Optional
 
 import httpx
-from nicegui import ui
+from nicegui import app, ui
 
 # API configuration
 API_BASE_URL = os.getenv("API_BASE_URL", "http://127.0.0.1:8000")
 DEMO_API_KEY = os.getenv("DEMO_API_KEY", "demo-key-123")
 
+# Shared HTTP client so searches reuse keep-alive connections to the backend
+# instead of paying a TCP+TLS handshake on every request
+_client = httpx.AsyncClient(
+    base_url=API_BASE_URL,
+    headers={"X-API-Key": DEMO_API_KEY},
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=20),
+)
+app.on_shutdown(_client.aclose)
+
 # Logging configuration
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 logging.basicConfig(
@@ -22,27 +32,43 @@ log = logging.getLogger(__name__)
 # Product categories for the outdoor gear store
 CATEGORIES = ["Camping Gear", "Apparel", "Footwear", "Winter Sports"]
 
+# Delay before a search fires, so rapid Enter presses coalesce into one request
+SEARCH_DEBOUNCE_SECS = 0.2
+
+# Outdoor gear icons, assigned to products deterministically by id
+OUTDOOR_ICONS = (
+    "🏔️",
+    "⛺",
+    "🎒",
+    "🥾",
+    "🧗",
+    "🏕️",
+    "🔦",
+    "🧭",
+    "⛷️",
+    "🏂",
+    "🚵",
+    "🏃",
+    "🎿",
+    "🥇",
+    "⚡",
+    "🌲",
+)
+
 
 class OutdoorGearStore:
     def __init__(self):
         self.current_query = ""
         self.current_category = "Camping Gear"
+        self._active_search: Optional[asyncio.Task] = None
 
     async def search_products(
         self, query: str, category: str, k: int = 10
     ) -> Optional[List[Dict]]:
         """Search products using the FastAPI backend"""
         try:
-            headers = {"X-API-Key": DEMO_API_KEY}
             params = {"search_query": query, "category": category, "k": k}
-
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{API_BASE_URL}/search-products",
-                    headers=headers,
-                    params=params,
-                    timeout=30.0,
-                )
+            response = await _client.get("/search-products", params=params)
 
             if response.status_code == 200:
                 data = response.json()
@@ -63,26 +89,8 @@ class OutdoorGearStore:
 
     def create_product_card(self, product: Dict) -> None:
         """Create a product card UI component"""
-        # Random outdoor gear icons
-        outdoor_icons = [
-            "🏔️",
-            "⛺",
-            "🎒",
-            "🥾",
-            "🧗",
-            "🏕️",
-            "🔦",
-            "🧭",
-            "⛷️",
-            "🏂",
-            "🚵",
-            "🏃",
-            "🎿",
-            "🥇",
-            "⚡",
-            "🌲",
-        ]
-        icon = random.choice(outdoor_icons)
+        # Stable icon per product so re-renders don't reshuffle the cards
+        icon = OUTDOOR_ICONS[hash(product.get("id", 0)) % len(OUTDOOR_ICONS)]
 
         with ui.card().classes(
             "w-full h-full shadow-lg hover:shadow-xl transition-shadow duration-300"
@@ -146,6 +154,24 @@ class OutdoorGearStore:
 
         dialog.open()
 
+    def schedule_search(self, query_input, category_select, results_container) -> None:
+        """Debounce the search and cancel any request still in flight"""
+        if self._active_search and not self._active_search.done():
+            self._active_search.cancel()
+        self._active_search = asyncio.create_task(
+            self._debounced_search(query_input, category_select, results_container)
+        )
+
+    async def _debounced_search(
+        self, query_input, category_select, results_container
+    ) -> None:
+        """Wait out the debounce window, then run the search"""
+        try:
+            await asyncio.sleep(SEARCH_DEBOUNCE_SECS)
+            await self.perform_search(query_input, category_select, results_container)
+        except asyncio.CancelledError:
+            pass
+
     async def perform_search(
         self, query_input, category_select, results_container
     ) -> None:
@@ -345,7 +371,7 @@ class OutdoorGearStore:
             # Add ENTER key handler for search (must be after results_container is defined)
             query_input2.on(
                 "keydown.enter",
-                lambda: self.perform_search(
+                lambda: self.schedule_search(
                     query_input2, category_select2, results_container
                 ),
             )
@@ -1,5 +1,20 @@
+import asyncio
+import hashlib
+import operator
+from concurrent.futures import ThreadPoolExecutor
+import os
+import queue
+import string
+import tempfile
+import threading
+import uuid
+from contextlib import asynccontextmanager
+
+import diskcache
 import mariadb
-from fastapi import FastAPI
+import numpy as np
+from fastapi import BackgroundTasks, FastAPI
+from fastapi.responses import ORJSONResponse
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_mariadb import MariaDBStore
 
@@ -10,49 +25,554 @@ DB_USER = "root"
 DB_PASSWORD = "password"
 DB_DATABASE = "demo"
 
-# MariaDB connection
-connection = mariadb.connect(
-    host=DB_HOST,
-    port=DB_PORT,
-    user=DB_USER,
-    password=DB_PASSWORD,
-    database=DB_DATABASE,
-    ssl=True,
+# TLS adds a full handshake (plus cert verification CPU) to every new
+# connection; skip it when the server is local, where it protects nothing
+DB_SSL = DB_HOST not in ("127.0.0.1", "localhost", "::1")
+
+# Number of products embedded per batch during ingestion, and how many
+# batches are embedded in parallel
+INGEST_BATCH_SIZE = 128
+INGEST_CONCURRENCY = 8
+
+# Rows pulled from MariaDB per C-level fetchmany call during ingestion
+INGEST_FETCH_SIZE = 10000
+
+# Embedding dimensions of the Gemini embedding model
+EMBEDDING_LENGTH = 3072
+
+# HNSW vector index parameter (max links per graph node)
+HNSW_M = 16
+
+# Semantic cache settings
+SEMANTIC_CACHE_SIZE = 1024
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+# Max concurrent background prefetch embeddings (protects the API quota)
+PREFETCH_CONCURRENCY = 2
+
+# On-disk query-embedding cache (survives restarts, shared across workers)
+EMBEDDING_CACHE_DIR = os.getenv(
+    "EMBEDDING_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "webinar_embedding_cache"),
+)
+EMBEDDING_CACHE_SIZE_BYTES = 2 << 30
+
+# Brute-force fallback for servers without vector-index support: directory
+# holding embeddings.f32 ([N, EMBEDDING_LENGTH] float32) plus names.npy,
+# produced by dump_embedding_matrix(). Unset (the default) disables it
+EMBEDDING_MATRIX_DIR = os.getenv("EMBEDDING_MATRIX_DIR", "")
+
+# Per-worker pool size: uvicorn workers each get their own pool after fork,
+# so divide the connection budget across them to stay under the server's
+# max_connections (WEB_CONCURRENCY is what uvicorn/gunicorn workers export)
+DB_POOL_SIZE = max(
+    4, (os.cpu_count() or 4) // int(os.getenv("WEB_CONCURRENCY", "1"))
 )
 
-# MariaDB vector store
-vector_store = MariaDBStore(
-    embeddings=GoogleGenerativeAIEmbeddings(model="gemini-embedding-001"),
-    embedding_length=3072,
-    datasource=f"mariadb+mariadbconnector://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_DATABASE}?ssl=true",
+# Database handles, created per worker in the lifespan below rather than at
+# import so no connection is ever opened before uvicorn forks its workers
+pool: mariadb.ConnectionPool = None
+vector_store: MariaDBStore = None
+embedding_matrix = None
+
+
+# Make sure the embedding column has an HNSW vector index so similarity
+# searches traverse the ANN graph instead of scanning every vector
+def ensure_vector_index():
+    connection = pool.get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(
+            """
+            SELECT COUNT(*) FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE()
+                AND TABLE_NAME = 'langchain_embedding'
+                AND INDEX_TYPE = 'VECTOR';
+            """
+        )
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(
+                f"""
+                ALTER TABLE langchain_embedding
+                ADD VECTOR INDEX idx_embedding (embedding) M={HNSW_M} DISTANCE=cosine;
+                """
+            )
+    finally:
+        connection.close()
+
+
+# Make sure products(name) has a FULLTEXT index; without one the MATCH ...
+# AGAINST ranking falls back to a full table scan
+def ensure_fulltext_index():
+    connection = pool.get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(
+            "CREATE FULLTEXT INDEX IF NOT EXISTS ft_products_name ON products(name);"
+        )
+    finally:
+        connection.close()
+
+
+# Semantic cache: paraphrased queries whose embeddings are close enough to a
+# cached one return the cached results without touching the vector store
+class SemanticCache:
+    def __init__(self, size: int, threshold: float):
+        self.size = size
+        self.threshold = threshold
+        # Cached embeddings are scalar-quantized to int8 with a per-vector
+        # scale: 4x less memory than float32 for the resident matrix, and
+        # plenty of precision for a 0.95 similarity threshold
+        self.vectors = np.zeros((size, EMBEDDING_LENGTH), dtype=np.int8)
+        self.scales = np.zeros(size, dtype=np.float32)
+        self.entries = []  # (fingerprint, results) parallel to the rows above
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def quantize(unit: np.ndarray) -> tuple[np.ndarray, float]:
+        scale = float(np.abs(unit).max()) / 127.0 or 1.0
+        return np.round(unit / scale).astype(np.int8), scale
+
+    @staticmethod
+    def fingerprint(query: str) -> str:
+        # Normalized lexical form, guards against embedding near-misses with
+        # different meanings (e.g. acronyms) by matching exact queries first
+        return " ".join(query.lower().split())
+
+    def get(self, query: str, query_vector) -> list | None:
+        fingerprint = self.fingerprint(query)
+        unit = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(unit)
+        if norm:
+            unit = unit / norm
+        with self.lock:
+            count = len(self.entries)
+            if count == 0:
+                return None
+            for cached_fingerprint, results in self.entries:
+                if cached_fingerprint == fingerprint:
+                    return results
+            # Dequantize on the fly: row_i8 * scale_i approximates the
+            # original unit vector, so the dot products stay comparable
+            similarities = (
+                self.vectors[:count].astype(np.float32) @ unit
+            ) * self.scales[:count]
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                return self.entries[best][1]
+        return None
+
+    def put(self, query: str, query_vector, results: list) -> None:
+        unit = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(unit)
+        if norm:
+            unit = unit / norm
+        quantized, scale = self.quantize(unit)
+        with self.lock:
+            if len(self.entries) < self.size:
+                slot = len(self.entries)
+                self.entries.append((self.fingerprint(query), results))
+            else:
+                # Full: overwrite the oldest entry
+                slot = self.next_slot
+                self.entries[slot] = (self.fingerprint(query), results)
+                self.next_slot = (slot + 1) % self.size
+            self.vectors[slot] = quantized
+            self.scales[slot] = scale
+
+
+semantic_cache = SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD)
+
+# Exact-match embedding cache on disk: repeated queries skip the embedding
+# API even after a cold start, when the in-process caches are empty
+embedding_cache = diskcache.Cache(
+    EMBEDDING_CACHE_DIR, size_limit=EMBEDDING_CACHE_SIZE_BYTES
 )
 
 
-# FastAPI app
-app = FastAPI()
+def embed_query_cached(query: str) -> list[float]:
+    key = hashlib.sha256(query.encode()).digest()
+    raw = embedding_cache.get(key)
+    if raw is not None:
+        return np.frombuffer(raw, np.float32).tolist()
+    vector = vector_store.embeddings.embed_query(query)
+    embedding_cache.set(key, np.asarray(vector, np.float32).tobytes())
+    return vector
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global pool, vector_store, embedding_matrix
+    # Connection pool (a connection per request instead of one shared
+    # socket serializing all requests)
+    pool = mariadb.ConnectionPool(
+        pool_name="webinar",
+        pool_size=DB_POOL_SIZE,
+        host=DB_HOST,
+        port=DB_PORT,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        database=DB_DATABASE,
+        ssl=DB_SSL,
+        # COM_RESET_CONNECTION on pool return would deallocate the
+        # server-side prepared statements cached per connection; these
+        # sessions hold no state that needs resetting
+        pool_reset_connection=False,
+    )
+    # MariaDB vector store; gRPC transport so parallel embedding calls
+    # multiplex over one persistent HTTP/2 channel instead of a TCP+TLS
+    # handshake per request
+    vector_store = MariaDBStore(
+        embeddings=GoogleGenerativeAIEmbeddings(
+            model="gemini-embedding-001", transport="grpc"
+        ),
+        embedding_length=EMBEDDING_LENGTH,
+        datasource=f"mariadb+mariadbconnector://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_DATABASE}?ssl={str(DB_SSL).lower()}",
+    )
+    ensure_vector_index()
+    ensure_fulltext_index()
+    if EMBEDDING_MATRIX_DIR:
+        # Missing files just mean no export has run yet: stay on the SQL
+        # path and let the post-ingestion dump populate the matrix
+        try:
+            embedding_matrix = EmbeddingMatrix(EMBEDDING_MATRIX_DIR)
+        except FileNotFoundError:
+            embedding_matrix = None
+    app.state.pool = pool
+    app.state.vector_store = vector_store
+    yield
+    pool.close()
+
+
+# FastAPI app; orjson serializes the list-of-strings payloads in C instead
+# of the stdlib json encoder
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+
+# Text search statement. MATCH in the WHERE clause is what activates the
+# fulltext index; BOOLEAN mode keeps short queries from being dropped as
+# stop-words. WHERE and ORDER BY use the identical MATCH expression, which
+# the optimizer spots and evaluates once, so the fulltext iterator hands
+# back rows already ranked (EXPLAIN: type=fulltext, key=ft_products_name)
+TEXT_SEARCH_SQL = """
+    SELECT name
+    FROM products
+    WHERE MATCH(name) AGAINST(? IN BOOLEAN MODE)
+    ORDER BY MATCH(name) AGAINST(? IN BOOLEAN MODE) DESC
+    LIMIT 10;
+    """
+
+
+def iter_name_chunks(cursor, batch_size: int = INGEST_FETCH_SIZE):
+    # Yield first-column values as plain lists, one per fetchmany call:
+    # rows cross the driver boundary in large C-level batches and
+    # itemgetter strips the tuples without a Python-level step per row
+    getter = operator.itemgetter(0)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield list(map(getter, rows))
+
+
+def run_text_search(query: str):
+    connection = pool.get_connection()
+    try:
+        # Reuse one server-side prepared statement per pooled connection, so
+        # the statement is parsed and planned only the first time each
+        # connection serves a text search
+        cursor = getattr(connection, "_text_search_cursor", None)
+        if cursor is None:
+            cursor = connection.cursor(prepared=True)
+            connection._text_search_cursor = cursor
+        cursor.execute(TEXT_SEARCH_SQL, (query, query))
+        return list(map(operator.itemgetter(0), cursor.fetchall()))
+    finally:
+        connection.close()  # returns the connection to the pool
+
+
+# Queries shorter than the server's ft_min_word_len (default 4, commonly
+# lowered to 3) can never match a fulltext word, so skip the round trip
+MIN_TEXT_SEARCH_LENGTH = 3
 
 
 # text search endpoint
 @app.get("/products/text-search")
-def text_search(query: str):
-    cursor = connection.cursor()
-    cursor.execute(
-        "SELECT name FROM products ORDER BY MATCH(name) AGAINST(?) LIMIT 10;", (query,)
+async def text_search(query: str):
+    query = query.strip()
+    if len(query) < MIN_TEXT_SEARCH_LENGTH:
+        return []
+    # Trailing wildcard on the last word: BOOLEAN mode then prefix-matches
+    # it, which is what search-as-you-type callers expect mid-word
+    if query[-1].isalnum():
+        query += "*"
+    return await asyncio.to_thread(run_text_search, query)
+
+
+def add_product_batch(names: list[str]):
+    # Ids are derived from the product name so re-running the ingestion
+    # overwrites embeddings instead of duplicating them
+    vector_store.add_texts(
+        names,
+        ids=[hashlib.md5(name.encode()).hexdigest() for name in names],
     )
-    return [name for (name,) in cursor]
 
 
-# product ingestion endpoint
-@app.post("/products/ingest")
-def ingest_products():
-    cursor = connection.cursor()
-    cursor.execute("SELECT name FROM products;")
-    vector_store.add_texts([name for (name,) in cursor])
-    return "Products ingested successfully"
+def run_product_ingestion():
+    connection = pool.get_connection()
+    try:
+        # Unbuffered cursor: rows stream from the server on demand instead of
+        # the whole result set being materialized client-side first
+        cursor = connection.cursor(buffered=False)
+        cursor.execute("SELECT name FROM products;")
+
+        # A producer thread feeds name chunks into a bounded queue so
+        # fetching the next rows from MariaDB overlaps with the embedding
+        # calls; chunks rather than single rows keep queue traffic low
+        chunk_queue: queue.Queue = queue.Queue(maxsize=4)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for chunk in iter_name_chunks(cursor):
+                    if stop.is_set():
+                        break
+                    chunk_queue.put(chunk)
+            finally:
+                chunk_queue.put(None)  # end-of-stream marker
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+
+        # Embed several batches in parallel; the gRPC channel multiplexes
+        # the concurrent calls over a single connection. At most
+        # INGEST_CONCURRENCY batches are in flight: waiting on the oldest
+        # future before submitting another keeps the executor's unbounded
+        # work queue empty, so backpressure reaches the producer and
+        # resident memory stays capped at the queue plus the open batches
+        try:
+            with ThreadPoolExecutor(max_workers=INGEST_CONCURRENCY) as executor:
+                in_flight = []
+
+                def submit(names):
+                    if len(in_flight) == INGEST_CONCURRENCY:
+                        in_flight.pop(0).result()
+                    in_flight.append(executor.submit(add_product_batch, names))
+
+                batch = []
+                while True:
+                    chunk = chunk_queue.get()
+                    if chunk is None:
+                        break
+                    for name in chunk:
+                        batch.append(name)
+                        if len(batch) == INGEST_BATCH_SIZE:
+                            submit(batch)
+                            batch = []
+                if batch:
+                    submit(batch)
+                for future in in_flight:
+                    future.result()  # surface any embedding/insert errors
+        except BaseException:
+            # On failure, unblock the producer (it may be waiting on a full
+            # queue) and drain up to its end-of-stream marker so it exits
+            # before the connection is released
+            stop.set()
+            while chunk_queue.get() is not None:
+                pass
+            raise
+        finally:
+            producer.join()
+            # Discard any rows the streaming cursor never fetched, so the
+            # pool never receives a connection with an open result set
+            cursor.close()
+
+        if EMBEDDING_MATRIX_DIR:
+            # Refresh the brute-force fallback files and remap the matrix
+            # so searches see what this run just ingested
+            global embedding_matrix
+            dump_embedding_matrix(EMBEDDING_MATRIX_DIR)
+            embedding_matrix = EmbeddingMatrix(EMBEDDING_MATRIX_DIR)
+
+        return "Products ingested successfully"
+    finally:
+        connection.close()  # returns the connection to the pool
+
+
+# Ingestion job statuses, keyed by job id. In-process on purpose: this demo
+# runs a single API process, so a broker-backed task queue would add
+# infrastructure without adding capacity
+ingestion_jobs: dict[str, str] = {}
+
+
+def run_ingestion_job(job_id: str) -> None:
+    ingestion_jobs[job_id] = "running"
+    try:
+        run_product_ingestion()
+    except Exception as exc:
+        ingestion_jobs[job_id] = f"failed: {exc}"
+    else:
+        ingestion_jobs[job_id] = "finished"
+
+
+# product ingestion endpoint: returns 202 with a job id immediately instead
+# of holding the request open for the whole multi-minute embed run
+@app.post("/products/ingest", status_code=202)
+async def ingest_products(background_tasks: BackgroundTasks):
+    job_id = uuid.uuid4().hex
+    ingestion_jobs[job_id] = "queued"
+    background_tasks.add_task(run_ingestion_job, job_id)
+    return {"job_id": job_id, "status": "queued"}
+
+
+# ingestion job status endpoint
+@app.get("/products/ingest/{job_id}")
+async def ingestion_status(job_id: str):
+    return {"job_id": job_id, "status": ingestion_jobs.get(job_id, "unknown")}
+
+
+# Vector search statement, resolved through the HNSW index. Only content is
+# selected: the endpoint never used metadata, so there is no reason to pull
+# it over the wire or build Document objects around it
+VECTOR_SEARCH_SQL = """
+    SELECT content
+    FROM langchain_embedding
+    ORDER BY VEC_DISTANCE_COSINE(embedding, Vec_FromText(?))
+    LIMIT ?;
+    """
+
+
+def run_vector_search(connection, query_vector, k: int) -> list[str]:
+    # Reuse one server-side prepared statement per pooled connection, same
+    # pattern as the text search
+    cursor = getattr(connection, "_vector_search_cursor", None)
+    if cursor is None:
+        cursor = connection.cursor(prepared=True)
+        connection._vector_search_cursor = cursor
+    vector_text = "[" + ",".join(map(str, query_vector)) + "]"
+    cursor.execute(VECTOR_SEARCH_SQL, (vector_text, k))
+    return [content for (content,) in cursor]
+
+
+_prefetch_semaphore = threading.Semaphore(PREFETCH_CONCURRENCY)
+
+
+def prefetch_variants(query: str, results: list[str]) -> None:
+    # Warm the caches with queries the user is likely to type next: the
+    # normalized forms of this query and the names it returned. Cold misses
+    # on those become warm hits, without blocking the request that ran
+    stripped = query.translate(str.maketrans("", "", string.punctuation))
+    variants = [query.lower(), " ".join(stripped.split()), *results[:3]]
+    seen = {semantic_cache.fingerprint(query)}
+    for variant in variants:
+        fingerprint = semantic_cache.fingerprint(variant)
+        if not variant or fingerprint in seen:
+            continue
+        seen.add(fingerprint)
+        with _prefetch_semaphore:
+            try:
+                vector = embed_query_cached(variant)
+            except Exception:
+                return  # embedding API hiccup; prefetching is best-effort
+        semantic_cache.put(variant, vector, results)
+
+
+# Memory-mapped replica of the embedding column for deployments where the
+# server cannot build an HNSW index: one contiguous float32 matrix scored
+# with a single BLAS matrix-vector product instead of a per-row SQL scan
+class EmbeddingMatrix:
+    def __init__(self, directory: str):
+        self.names = np.load(os.path.join(directory, "names.npy"))
+        if len(self.names) == 0:
+            # np.memmap refuses to map an empty file
+            self.vectors = np.empty((0, EMBEDDING_LENGTH), dtype=np.float32)
+            return
+        self.vectors = np.memmap(
+            os.path.join(directory, "embeddings.f32"),
+            dtype=np.float32,
+            mode="r",
+            shape=(len(self.names), EMBEDDING_LENGTH),
+        )
+
+    def search(self, query_vector, k: int) -> list[str]:
+        if len(self.names) == 0:
+            return []
+        scores = self.vectors @ np.asarray(query_vector, dtype=np.float32)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [str(self.names[i]) for i in top]
+
+
+def dump_embedding_matrix(directory: str) -> int:
+    # Export the embedding column to the matrix files above; meant to run
+    # periodically (e.g. nightly) after ingestion, not per request
+    connection = pool.get_connection()
+    try:
+        cursor = connection.cursor(buffered=False)
+        cursor.execute("SELECT content, embedding FROM langchain_embedding;")
+        names: list[str] = []
+        blob = bytearray()
+        while True:
+            rows = cursor.fetchmany(INGEST_FETCH_SIZE)
+            if not rows:
+                break
+            for content, embedding in rows:
+                names.append(content)
+                blob += embedding  # VECTOR values are packed float32
+    finally:
+        connection.close()  # returns the connection to the pool
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, "names.npy"), np.array(names))
+    with open(os.path.join(directory, "embeddings.f32"), "wb") as f:
+        f.write(blob)
+    return len(names)
 
 
 # semantic search endpoint
 @app.get("/products/semantic-search")
-def search_products(query: str):
-    results = vector_store.similarity_search(query, k=10)
-    return [doc.page_content for doc in results]
+async def search_products(query: str, background_tasks: BackgroundTasks):
+    if embedding_matrix is not None:
+        # Brute-force fallback: score the memory-mapped matrix in-process,
+        # no database round trip at all
+        query_vector = await asyncio.to_thread(embed_query_cached, query)
+        cached_results = semantic_cache.get(query, query_vector)
+        if cached_results is not None:
+            return cached_results
+        results = await asyncio.to_thread(
+            embedding_matrix.search, query_vector, 10
+        )
+        semantic_cache.put(query, query_vector, results)
+        background_tasks.add_task(prefetch_variants, query, results)
+        return results
+
+    # Start the embedding and the pool checkout together: acquiring (and
+    # possibly reconnecting) a database connection hides entirely under the
+    # embedding RPC instead of being paid afterwards. return_exceptions so a
+    # failed embedding cannot leak the connection the other thread checked
+    # out: close whatever was acquired before re-raising
+    query_vector, connection = await asyncio.gather(
+        asyncio.to_thread(embed_query_cached, query),
+        asyncio.to_thread(pool.get_connection),
+        return_exceptions=True,
+    )
+    if isinstance(query_vector, BaseException):
+        if not isinstance(connection, BaseException):
+            connection.close()
+        raise query_vector
+    if isinstance(connection, BaseException):
+        raise connection
+    try:
+        cached_results = semantic_cache.get(query, query_vector)
+        if cached_results is not None:
+            return cached_results
+
+        results = await asyncio.to_thread(
+            run_vector_search, connection, query_vector, 10
+        )
+        semantic_cache.put(query, query_vector, results)
+        background_tasks.add_task(prefetch_variants, query, results)
+        return results
+    finally:
+        connection.close()  # returns the connection to the pool